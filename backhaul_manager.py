@@ -6,6 +6,8 @@ import json
 import time
 import shutil
 import re
+import socket
+from concurrent.futures import ThreadPoolExecutor
 from urllib import request
 import random
 import string
@@ -23,6 +25,8 @@ class C:
 
 BACKHAUL_DIR, CONFIG_DIR, SERVICE_DIR = "/opt/backhaul", "/etc/backhaul", "/etc/systemd/system"
 LOG_DIR, BINARY_PATH, TUNNELS_DIR = "/var/log/backhaul", f"{BACKHAUL_DIR}/backhaul", f"{CONFIG_DIR}/tunnels"
+CORE_VERSION, CORES_DIR = "v0.6.5", f"{BACKHAUL_DIR}/cores"
+HEALTH_TIMEOUT, HEALTH_INTERVAL, SETTLE_WINDOW = 30, 0.5, 5
 
 # --- Helper Functions ---
 def run_cmd(command, as_root=False, capture=True):
@@ -125,14 +129,78 @@ def parse_toml_config(config_path):
     
     return tunnel_info
 
+def is_service_active(service_name):
+    result = run_cmd(['systemctl', 'is-active', service_name])
+    return result.returncode == 0 and result.stdout.strip() == "active"
+
 def get_service_status(service_name):
     """Get detailed service status"""
-    result = run_cmd(['systemctl', 'is-active', service_name])
-    if result.returncode == 0 and result.stdout.strip() == "active":
+    if is_service_active(service_name):
         return f"{C.GREEN}● Active{C.RESET}"
     else:
         return f"{C.RED}● Inactive{C.RESET}"
 
+def list_tunnel_names():
+    try: return [f[:-5] for f in sorted(os.listdir(TUNNELS_DIR)) if f.endswith(".toml")]
+    except FileNotFoundError: return []
+
+def get_probe_addr(tunnel_name):
+    """Return the local (host, port) a server tunnel listens on, or None"""
+    tunnel_data = parse_toml_config(f"{TUNNELS_DIR}/{tunnel_name}.toml")
+    # A client's remote_addr belongs to the other side, so it says nothing about the local core
+    if tunnel_data['type'] != "Server": return None
+    host, _, port = tunnel_data['addr'].rpartition(':')
+    if not port.isdigit(): return None
+    host = host.strip('[]')
+    if host in ("", "0.0.0.0", "::"): host = "127.0.0.1"
+    return host, int(port)
+
+def probe_tcp(addr, timeout=2):
+    try:
+        with socket.create_connection(addr, timeout=timeout): return True
+    except OSError: return False
+
+def get_unit_state(service_name):
+    """Return (ActiveState, MainPID, NRestarts) of a systemd unit"""
+    result = run_cmd(['systemctl', 'show', '-p', 'ActiveState,MainPID,NRestarts', service_name])
+    props = dict(line.split('=', 1) for line in result.stdout.splitlines() if '=' in line)
+    return props.get('ActiveState', 'unknown'), props.get('MainPID', '0'), props.get('NRestarts', '0')
+
+def wait_for_tunnel_health(tunnel_name, probe_addr, started):
+    """Return seconds until the tunnel came up and stayed up for SETTLE_WINDOW, or None"""
+    service_name = f"backhaul-{tunnel_name}.service"
+    deadline = started + HEALTH_TIMEOUT
+    up_since, up_state = None, None
+    while True:
+        now = time.monotonic()
+        state = get_unit_state(service_name)
+        # Type=simple units report active right after fork, so the same MainPID and
+        # NRestarts must hold for the whole settle window to rule out a crash loop
+        if state[0] == "active" and state[1] != "0" and (probe_addr is None or probe_tcp(probe_addr)):
+            if state != up_state: up_since, up_state = now, state
+            elif now - up_since >= SETTLE_WINDOW: return up_since - started
+        else:
+            up_since, up_state = None, None
+        if now >= deadline + SETTLE_WINDOW or (up_since is None and now >= deadline): return None
+        time.sleep(HEALTH_INTERVAL)
+
+def switch_core(target_path):
+    """Atomically point BINARY_PATH at target_path (symlink + rename)"""
+    tmp_link = f"{BINARY_PATH}.new"
+    if run_cmd(['ln', '-sfn', target_path, tmp_link], as_root=True).returncode != 0: return False
+    return run_cmd(['mv', '-Tf', tmp_link, BINARY_PATH], as_root=True).returncode == 0
+
+def restart_tunnel_wave(wave, probes):
+    """Restart a wave of tunnels and return {name: downtime seconds or None if unhealthy}"""
+    if not wave: return {}
+    started = {}
+    for tunnel_name in wave:
+        started[tunnel_name] = time.monotonic()
+        run_cmd(['systemctl', 'restart', f'backhaul-{tunnel_name}.service'], as_root=True)
+    with ThreadPoolExecutor(max_workers=len(wave)) as pool:
+        results = pool.map(lambda t: wait_for_tunnel_health(t, probes[t], started[t]), wave)
+        return dict(zip(wave, results))
+
 # --- Feature Functions ---
 def create_server_tunnel():
     clear_screen()
@@ -450,16 +518,82 @@ def configure_new_tunnel():
         colorize("Invalid choice.", C.RED)
         time.sleep(1)
 
+def rollback_core(previous_path, restarted, probes):
+    """Switch back to previous_path and restart tunnels; return their downtimes or None if not rolled back"""
+    if not previous_path:
+        colorize("No previous core to roll back to.", C.RED)
+        return None
+    colorize("Rolling back to the previous core...", C.YELLOW)
+    if not switch_core(previous_path):
+        colorize("✗ Failed to switch back to the previous core. Tunnels were not restarted.", C.RED, bold=True)
+        return None
+    rollback = restart_tunnel_wave(restarted, probes)
+    still_down = [t for t in restarted if rollback[t] is None]
+    if still_down: colorize(f"✗ Still unhealthy after rollback: {', '.join(sanitize_for_print(t) for t in still_down)}", C.RED)
+    else: colorize("✓ Rollback completed, all tunnels healthy.", C.GREEN)
+    return rollback
+
+def format_downtime(tunnel_name, downtimes):
+    if tunnel_name not in downtimes: return f"{C.WHITE}{'-':<14}{C.RESET}"
+    if downtimes[tunnel_name] is None: return f"{C.RED}{'unhealthy':<14}{C.RESET}"
+    return f"{C.GREEN}{downtimes[tunnel_name]:<14.1f}{C.RESET}"
+
+def rolling_upgrade_core(staged_path, previous_path):
+    """Switch to staged_path and restart running tunnels in health-gated waves"""
+    active_tunnels = [t for t in list_tunnel_names() if is_service_active(f"backhaul-{t}.service")]
+    # Only gate on the TCP probe for tunnels that passed it before the upgrade
+    probes = {}
+    for tunnel_name in active_tunnels:
+        probe_addr = get_probe_addr(tunnel_name)
+        probes[tunnel_name] = probe_addr if probe_addr and probe_tcp(probe_addr) else None
+
+    wave_size = 1
+    if active_tunnels:
+        colorize(f"\n{len(active_tunnels)} running tunnel(s) will be restarted on the new core.", C.CYAN)
+        try: wave_size = max(1, int(input("Tunnels to restart per wave (default: 1): ") or "1"))
+        except ValueError: wave_size = 1
+
+    if not switch_core(staged_path):
+        colorize("Failed to switch core symlink. Running tunnels were not touched.", C.RED)
+        return False
+    if not active_tunnels:
+        return True
+
+    downtimes, rollback, restarted, failed = {}, {}, [], []
+    try:
+        for i in range(0, len(active_tunnels), wave_size):
+            wave = active_tunnels[i:i + wave_size]
+            colorize(f"Wave {i // wave_size + 1}: restarting {', '.join(sanitize_for_print(t) for t in wave)}...", C.YELLOW)
+            restarted.extend(wave)
+            downtimes.update(restart_tunnel_wave(wave, probes))
+            failed = [t for t in wave if downtimes[t] is None]
+            if failed: break
+    except BaseException:
+        # Never leave BINARY_PATH on the new core while tunnels still run the old one
+        colorize("\n✗ Upgrade interrupted.", C.RED, bold=True)
+        rollback_core(previous_path, restarted, probes)
+        raise
+
+    if failed:
+        colorize(f"✗ Health check failed for: {', '.join(sanitize_for_print(t) for t in failed)}", C.RED, bold=True)
+        rollback = rollback_core(previous_path, restarted, probes) or {}
+
+    colorize("\n--- Per-tunnel downtime (seconds) ---", C.CYAN)
+    print(f"{C.BOLD}   {'NAME':<20} {'UPGRADE':<14} {'ROLLBACK':<14}{C.RESET}")
+    for tunnel_name in active_tunnels:
+        print(f"   {sanitize_for_print(tunnel_name):<20} {format_downtime(tunnel_name, downtimes)} {format_downtime(tunnel_name, rollback)}")
+    return not failed
+
 def install_backhaul_core():
     clear_screen()
-    colorize("--- Installing Backhaul Core (v0.6.5) ---", C.YELLOW, bold=True)
+    colorize(f"--- Installing Backhaul Core ({CORE_VERSION}) ---", C.YELLOW, bold=True)
     
     try:
         arch = os.uname().machine
         if arch == "x86_64": 
-            url = "https://github.com/Musixal/Backhaul/releases/download/v0.6.5/backhaul_linux_amd64.tar.gz"
+            url = f"https://github.com/Musixal/Backhaul/releases/download/{CORE_VERSION}/backhaul_linux_amd64.tar.gz"
         elif arch == "aarch64": 
-            url = "https://github.com/Musixal/Backhaul/releases/download/v0.6.5/backhaul_linux_arm64.tar.gz"
+            url = f"https://github.com/Musixal/Backhaul/releases/download/{CORE_VERSION}/backhaul_linux_arm64.tar.gz"
         else: 
             colorize(f"Unsupported architecture: {arch}", C.RED)
             press_key()
@@ -477,15 +611,45 @@ def install_backhaul_core():
                 press_key()
                 return
         
-        # Extract and install
-        run_cmd(["tar", "-xzf", "/tmp/backhaul.tar.gz", "-C", "/tmp"])
-        run_cmd(["mv", "/tmp/backhaul", BINARY_PATH], as_root=True)
-        run_cmd(["chmod", "+x", BINARY_PATH], as_root=True)
-        
-        # Clean up
+        # Extract and stage under a versioned path, leaving the running core untouched
+        result = run_cmd(["tar", "-xzf", "/tmp/backhaul.tar.gz", "-C", "/tmp"])
         run_cmd(["rm", "-f", "/tmp/backhaul.tar.gz"], as_root=True)
+        if result.returncode != 0:
+            colorize("Failed to extract the downloaded archive. Current core left in place.", C.RED)
+            press_key()
+            return
+        staged_path = f"{CORES_DIR}/backhaul-{CORE_VERSION}-{int(time.time())}"
+        run_cmd(["mkdir", "-p", CORES_DIR], as_root=True)
+        result = run_cmd(["mv", "/tmp/backhaul", staged_path], as_root=True)
+        run_cmd(["chmod", "+x", staged_path], as_root=True)
+        if result.returncode != 0 or not os.path.isfile(staged_path) or not os.access(staged_path, os.X_OK):
+            colorize("Failed to stage the new core binary. Current core left in place.", C.RED)
+            run_cmd(["rm", "-f", staged_path], as_root=True)
+            press_key()
+            return
         
-        colorize("✅ Backhaul Core v0.6.5 installed successfully!", C.GREEN, bold=True)
+        # Keep the current core around for rollback (older installs used a plain file)
+        previous_path = None
+        if os.path.islink(BINARY_PATH):
+            if os.path.exists(BINARY_PATH): previous_path = os.path.realpath(BINARY_PATH)
+        elif os.path.exists(BINARY_PATH):
+            backup_path = f"{CORES_DIR}/backhaul-previous"
+            if run_cmd(["cp", "-p", BINARY_PATH, backup_path], as_root=True).returncode != 0:
+                colorize("Failed to back up the current core. Current core left in place.", C.RED)
+                run_cmd(["rm", "-f", staged_path], as_root=True)
+                press_key()
+                return
+            previous_path = backup_path
+        
+        if rolling_upgrade_core(staged_path, previous_path):
+            # Prune cores other than the current and previous one
+            for filename in os.listdir(CORES_DIR):
+                core_path = os.path.join(CORES_DIR, filename)
+                if core_path not in (staged_path, previous_path):
+                    run_cmd(["rm", "-f", core_path], as_root=True)
+            colorize(f"✅ Backhaul Core {CORE_VERSION} installed successfully!", C.GREEN, bold=True)
+        else:
+            colorize(f"❌ Backhaul Core {CORE_VERSION} upgrade failed.", C.RED, bold=True)
         
     except Exception as e:
         colorize(f"Installation error: {e}", C.RED)